@@ -132,6 +132,9 @@ os.environ["HTTPS_PROXY"] = ""
 
 local_embedding = config.get("local_embedding", False) # 是否使用本地embedding
 
+compile_model = config.get("compile_model", False) # 是否使用torch.compile编译本地模型，不能与8bit量化同时使用
+moss_load_in_8bit = config.get("moss_load_in_8bit", True) # 是否以8bit量化加载MOSS（需要bitsandbytes）
+
 @contextmanager
 def retrieve_proxy(proxy=None):
     """
@@ -1,27 +1,207 @@
 # 代码主要来源于 https://github.com/OpenLMLab/MOSS/blob/main/moss_inference.py
 
 import os
+import importlib.util
+import math
+import logging
 import torch
 import warnings
 import platform
 import time
-from typing import Union, List, Tuple, Optional, Dict
+import weakref
+from collections import OrderedDict
+from threading import Lock, Thread
+from typing import Union, Tuple, Optional
 
 from huggingface_hub import snapshot_download
+from transformers import BitsAndBytesConfig, CodeGenTokenizerFast, LogitsProcessor, LogitsProcessorList, TextIteratorStreamer
 from transformers.generation.utils import logger
-from accelerate import init_empty_weights, load_checkpoint_and_dispatch
-from transformers.modeling_outputs import BaseModelOutputWithPast
 try:
     from transformers import MossForCausalLM, MossTokenizer
 except (ImportError, ModuleNotFoundError):
     from .modeling_moss import MossForCausalLM
     from .tokenization_moss import MossTokenizer
-    from .configuration_moss import MossConfig
 
 from .base_model import BaseLLMModel
+from ..config import compile_model, moss_load_in_8bit
 
 MOSS_MODEL = None
 MOSS_TOKENIZER = None
+_LOAD_LOCK = Lock()
+
+# a session's KV cache is ~1.7 GB at 2048 tokens: only the most recently used sessions keep it
+# on the GPU, the next ones are parked in pinned host memory and the rest are dropped
+MAX_GPU_KV_CACHES = 2
+MAX_CPU_KV_CACHES = 4
+_KV_CACHE_LRU = OrderedDict()  # id(client) -> weakref to client, most recently used last
+_KV_CACHE_LOCK = Lock()
+
+
+def _maybe_compile(fn):
+    # default mode: CUDA graphs are per-thread and each streamed reply is sampled in a fresh Thread
+    if compile_model and hasattr(torch, "compile"):
+        return torch.compile(fn, dynamic=False)
+    return fn
+
+
+@_maybe_compile
+def process_logits(
+    logits: torch.Tensor,
+    seen_tokens: torch.Tensor,
+    temperature: torch.Tensor,
+    repetition_penalty: Optional[torch.Tensor],
+    top_k: int,
+    top_p: Optional[torch.Tensor],
+    filter_value: float = -float("Inf"),
+) -> torch.Tensor:
+    """
+    Applies repetition penalty, temperature, top-k and top-p filtering to the logits in one pass,
+    so that torch.compile can fuse the elementwise work into a few kernels.
+    The float knobs are 0-d tensors so changing them from the UI doesn't trigger a recompile.
+
+    Args:
+        logits (torch.Tensor): The next-token logits of shape (batch_size, vocab_size).
+        seen_tokens (torch.Tensor): A boolean mask of shape (batch_size, vocab_size) marking tokens already in the sequence, used for the repetition penalty.
+        temperature (torch.Tensor): The temperature for logits.
+        repetition_penalty (Optional[torch.Tensor]): The repetition penalty factor, None disables it.
+        top_k (int): The top-k value for filtering, 0 disables it.
+        top_p (Optional[torch.Tensor]): The top-p value for filtering, None disables it.
+        filter_value (float, optional): The value assigned to filtered logits. Defaults to -inf.
+
+    Returns:
+        torch.Tensor: The processed logits.
+    """
+    if repetition_penalty is not None:
+        # if score < 0 then repetition penalty has to be multiplied to reduce the previous token probability
+        # the mask has a fixed shape, so this is a flat O(vocab_size) elementwise op per step
+        # instead of a gather/scatter over the ever-growing input_ids
+        score = torch.where(
+            logits < 0, logits * repetition_penalty, logits / repetition_penalty)
+        logits = torch.where(seen_tokens, score, logits)
+
+    logits = logits / temperature
+
+    if top_k > 0:
+        # Only the top-k values can survive, so apply top-p on those (already sorted)
+        # instead of sorting the whole vocabulary
+        values, indices = torch.topk(logits, top_k)
+        if top_p is not None:
+            probs = torch.softmax(values, dim=-1)
+            cumulative_probs = torch.cumsum(probs, dim=-1)
+            values = values.masked_fill((cumulative_probs - probs) > top_p, filter_value)
+        return torch.full_like(logits, filter_value).scatter(1, indices, values)
+
+    if top_p is not None:
+        sorted_logits, sorted_indices = torch.sort(logits, descending=True)
+        sorted_probs = torch.softmax(sorted_logits, dim=-1)
+        cumulative_probs = torch.cumsum(sorted_probs, dim=-1)
+        # Remove tokens with cumulative probability above the threshold,
+        # shifted by one so the first token above the threshold is kept as well
+        sorted_indices_to_remove = (cumulative_probs - sorted_probs) > top_p
+        indices_to_remove = sorted_indices_to_remove.scatter(
+            1, sorted_indices, sorted_indices_to_remove)
+        logits = logits.masked_fill(indices_to_remove, filter_value)
+
+    return logits
+
+
+def past_key_values_to_cpu(past_key_values: Tuple[Tuple[torch.Tensor]]) -> Tuple[Tuple[torch.Tensor]]:
+    """
+    Copies a KV cache into pinned host memory, e.g. to park an idle session or hand it to another worker.
+    """
+    return tuple(
+        tuple(state.to("cpu").pin_memory() for state in layer_past)
+        for layer_past in past_key_values
+    )
+
+
+def past_key_values_to_cuda(past_key_values: Tuple[Tuple[torch.Tensor]]) -> Tuple[Tuple[torch.Tensor]]:
+    """
+    Moves a KV cache produced by past_key_values_to_cpu back onto the GPU.
+    """
+    return tuple(
+        tuple(state.to("cuda", non_blocking=True) for state in layer_past)
+        for layer_past in past_key_values
+    )
+
+
+def _touch_kv_cache(client) -> None:
+    """
+    Marks the client's KV cache as most recently used and moves it back to the GPU if it was parked,
+    then parks or drops the caches of the least recently used sessions. Call with _KV_CACHE_LOCK held.
+    """
+    _KV_CACHE_LRU.pop(id(client), None)
+    _KV_CACHE_LRU[id(client)] = weakref.ref(client)
+    if client._kv_cache is not None and not client._kv_cache[0][0].is_cuda:
+        client._kv_cache = past_key_values_to_cuda(client._kv_cache)
+
+    rank = 0
+    for key in reversed(list(_KV_CACHE_LRU)):
+        other = _KV_CACHE_LRU[key]()
+        if other is None:
+            del _KV_CACHE_LRU[key]
+            continue
+        if other is not client and other._kv_cache is None:
+            continue
+        if rank >= MAX_GPU_KV_CACHES + MAX_CPU_KV_CACHES:
+            other._kv_cache, other._kv_cache_ids = None, None
+            del _KV_CACHE_LRU[key]
+        elif rank >= MAX_GPU_KV_CACHES and other._kv_cache[0][0].is_cuda:
+            other._kv_cache = past_key_values_to_cpu(other._kv_cache)
+        rank += 1
+
+
+class MossLogitsProcessor(LogitsProcessor):
+    def __init__(
+        self,
+        temperature: float,
+        repetition_penalty: float,
+        top_k: int,
+        top_p: float,
+        stopwords: Optional[torch.Tensor] = None,
+        length_penalty: float = 1,
+        regulation_start: int = 512,
+    ) -> None:
+        self.temperature = temperature
+        self.repetition_penalty = repetition_penalty
+        self.top_k = top_k
+        self.top_p = top_p
+        self.stopwords = stopwords
+        self.length_penalty = length_penalty
+        self.regulation_start = regulation_start
+        self.seen_tokens = None
+        self.prompt_len = None
+        self.knobs = None
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
+        if self.seen_tokens is None:
+            self.seen_tokens = torch.zeros_like(scores, dtype=torch.bool).scatter_(1, input_ids, True)
+            self.prompt_len = input_ids.shape[1]
+            if self.stopwords is not None:
+                self.stopwords = self.stopwords.to(scores.device)
+            self.knobs = (
+                torch.tensor(self.temperature, dtype=scores.dtype, device=scores.device),
+                torch.tensor(self.repetition_penalty, dtype=scores.dtype, device=scores.device)
+                if self.repetition_penalty > 1 else None,
+                torch.tensor(self.top_p, dtype=scores.dtype, device=scores.device)
+                if self.top_p < 1.0 else None,
+            )
+        else:
+            # prefill/decode_step append exactly one token between calls
+            self.seen_tokens.scatter_(1, input_ids[:, -1:], True)
+        temperature, repetition_penalty, top_p = self.knobs
+        scores = process_logits(scores, self.seen_tokens, temperature, repetition_penalty, self.top_k, top_p)
+
+        cur_len = input_ids.shape[1] - self.prompt_len
+        if self.stopwords is not None and self.length_penalty != 1 and cur_len > self.regulation_start:
+            if self.length_penalty <= 0:
+                # a zero factor means the stop words can never be sampled
+                scores[:, self.stopwords] = -float("Inf")
+            else:
+                # scaling the stop word probabilities by length_penalty ** n is a shift of
+                # n * log(length_penalty) in logit space, applied with one indexed add
+                scores[:, self.stopwords] += (cur_len - self.regulation_start) * math.log(self.length_penalty)
+        return scores
 
 
 class MOSS_Client(BaseLLMModel):
@@ -31,21 +211,64 @@ class MOSS_Client(BaseLLMModel):
         logger.setLevel("ERROR")
         warnings.filterwarnings("ignore")
         if MOSS_MODEL is None:
-            model_path = "models/moss-moon-003-sft"
-            if not os.path.exists(model_path):
-                model_path = snapshot_download("fnlp/moss-moon-003-sft")
-
-            print("Waiting for all devices to be ready, it may take a few minutes...")
-            config = MossConfig.from_pretrained(model_path)
-            MOSS_TOKENIZER = MossTokenizer.from_pretrained(model_path)
-
-            with init_empty_weights():
-                raw_model = MossForCausalLM._from_config(
-                    config, torch_dtype=torch.float16)
-            raw_model.tie_weights()
-            MOSS_MODEL = load_checkpoint_and_dispatch(
-                raw_model, model_path, device_map="auto", no_split_module_classes=["MossBlock"], dtype=torch.float16
-            )
+            # double-checked so concurrent sessions don't each load the checkpoint
+            with _LOAD_LOCK:
+                if MOSS_MODEL is None:
+                    model_path = "models/moss-moon-003-sft"
+                    if not os.path.exists(model_path):
+                        model_path = snapshot_download("fnlp/moss-moon-003-sft")
+
+                    print("Waiting for all devices to be ready, it may take a few minutes...")
+                    try:
+                        # MossTokenizer is the CodeGen byte-level BPE, so the Rust-backed
+                        # CodeGenTokenizerFast can be built from the same vocab.json/merges.txt
+                        MOSS_TOKENIZER = CodeGenTokenizerFast.from_pretrained(model_path)
+                    except Exception as e:
+                        logging.warning(f"无法加载MOSS的fast tokenizer，将使用较慢的Python实现: {e}")
+                        MOSS_TOKENIZER = MossTokenizer.from_pretrained(model_path)
+
+                    # 8-bit weight-only quantization (LLM.int8()); MossBlock is kept
+                    # unsplit across devices through MossPreTrainedModel._no_split_modules
+                    quantization_config = None
+                    if moss_load_in_8bit:
+                        if importlib.util.find_spec("bitsandbytes") is not None:
+                            quantization_config = BitsAndBytesConfig(
+                                load_in_8bit=True, llm_int8_threshold=6.0)
+                        else:
+                            logging.warning("未安装bitsandbytes，MOSS将不使用8bit量化加载")
+                    # bf16 keeps the fp16 footprint with a wider range on Ampere and newer;
+                    # bitsandbytes int8 matmuls only take fp16, so quantized loads stay fp16
+                    # instead of casting bf16 to fp16 and back around every linear
+                    if quantization_config is None and torch.cuda.is_bf16_supported():
+                        dtype = torch.bfloat16
+                    else:
+                        dtype = torch.float16
+                    model = MossForCausalLM.from_pretrained(
+                        model_path, device_map="auto", torch_dtype=dtype,
+                        quantization_config=quantization_config)
+                    if compile_model and quantization_config is not None:
+                        # bitsandbytes Int8 linears break the graph, so compiling gains nothing
+                        logging.warning("compile_model与moss_load_in_8bit不能同时使用，MOSS将不进行编译")
+                    elif compile_model and hasattr(torch, "compile"):
+                        # compile transformer.forward directly rather than a wrapping pipeline,
+                        # so both the chunked prefill (which calls the transformer without
+                        # lm_head) and the decode steps go through it; then warm up once so
+                        # the first request doesn't pay compile cost.
+                        # Default mode, the same as process_logits: no CUDA graphs, since the
+                        # KV cache grows every step and graphs are per-thread while every
+                        # streamed reply runs in a fresh Thread, and no autotuning while
+                        # _LOAD_LOCK holds up the other sessions
+                        model.transformer.forward = torch.compile(
+                            model.transformer.forward, mode="default", dynamic=True, fullgraph=False)
+                        warmup_inputs = MOSS_TOKENIZER("<|Human|>: Hi<eoh>\n", return_tensors="pt")
+                        model.generate(
+                            warmup_inputs.input_ids.cuda(),
+                            attention_mask=warmup_inputs.attention_mask.cuda(),
+                            max_new_tokens=2,
+                            use_cache=True,
+                            pad_token_id=MOSS_TOKENIZER.pad_token_id)
+                    # publish only once fully loaded, other sessions skip the lock after this
+                    MOSS_MODEL = model
         self.system_prompt = \
             """You are an AI assistant whose name is MOSS.
     - MOSS is a conversational language model that is developed by Fudan University. It is designed to be helpful, honest, and harmless.
@@ -70,6 +293,11 @@ class MOSS_Client(BaseLLMModel):
         self.temperature = 0.7
         self.repetition_penalty = 1.1
         self.max_generation_token = 2048
+        self._cached_prompt_text = ""
+        self._cached_prompt_ids = None
+        self._kv_cache = None
+        self._kv_cache_ids = None
+        self.prefill_chunk_size = 512
 
         self.default_paras = {
             "temperature": 0.7,
@@ -81,21 +309,25 @@ class MOSS_Client(BaseLLMModel):
             "max_iterations": 512,
             "regulation_start": 512,
         }
-        self.num_layers, self.heads, self.hidden, self.vocab_size = 34, 24, 256, 107008
-
-        self.moss_startwords = torch.LongTensor([27, 91, 44, 18420, 91, 31175])
-        self.tool_startwords = torch.LongTensor(
-            [27, 91, 6935, 1746, 91, 31175])
-        self.tool_specialwords = torch.LongTensor([6045])
-
-        self.innerthought_stopwords = torch.LongTensor(
-            [MOSS_TOKENIZER.convert_tokens_to_ids("<eot>")])
-        self.tool_stopwords = torch.LongTensor(
-            [MOSS_TOKENIZER.convert_tokens_to_ids("<eoc>")])
-        self.result_stopwords = torch.LongTensor(
-            [MOSS_TOKENIZER.convert_tokens_to_ids("<eor>")])
-        self.moss_stopwords = torch.LongTensor(
-            [MOSS_TOKENIZER.convert_tokens_to_ids("<eom>")])
+
+        # built once on the GPU, so generation calls don't copy them over each time
+        self.moss_startwords = torch.tensor(
+            [27, 91, 44, 18420, 91, 31175], dtype=torch.long, device="cuda")
+        self.tool_startwords = torch.tensor(
+            [27, 91, 6935, 1746, 91, 31175], dtype=torch.long, device="cuda")
+        self.tool_specialwords = torch.tensor(
+            [6045], dtype=torch.long, device="cuda")
+
+        self.innerthought_stopwords = torch.tensor(
+            [MOSS_TOKENIZER.convert_tokens_to_ids("<eot>")], dtype=torch.long, device="cuda")
+        self.tool_stopwords = torch.tensor(
+            [MOSS_TOKENIZER.convert_tokens_to_ids("<eoc>")], dtype=torch.long, device="cuda")
+        self.result_stopwords = torch.tensor(
+            [MOSS_TOKENIZER.convert_tokens_to_ids("<eor>")], dtype=torch.long, device="cuda")
+        # plain ids, checked on the host by the _generate loop
+        self.moss_stopword_ids = [MOSS_TOKENIZER.convert_tokens_to_ids("<eom>")]
+        self.moss_stopwords = torch.tensor(
+            self.moss_stopword_ids, dtype=torch.long, device="cuda")
 
     def _get_main_instruction(self):
         return self.system_prompt + self.web_search_switch + self.calculator_switch + self.equation_solver_switch + self.text_to_image_switch + self.image_edition_switch + self.text_to_speech_switch
@@ -109,254 +341,254 @@ class MOSS_Client(BaseLLMModel):
                 context += '<|MOSS|>: ' + i["content"] + '<eom>'
         return context
 
-    def get_answer_at_once(self):
-        prompt = self._get_moss_style_inputs()
-        inputs = MOSS_TOKENIZER(prompt, return_tensors="pt")
-        with torch.no_grad():
-            outputs = MOSS_MODEL.generate(
-                inputs.input_ids.cuda(),
-                attention_mask=inputs.attention_mask.cuda(),
-                max_length=self.token_upper_limit,
-                do_sample=True,
-                top_k=self.top_k,
-                top_p=self.top_p,
-                temperature=self.temperature,
-                repetition_penalty=self.repetition_penalty,
-                num_return_sequences=1,
-                eos_token_id=106068,
-                pad_token_id=MOSS_TOKENIZER.pad_token_id)
-            response = MOSS_TOKENIZER.decode(
-                outputs[0][inputs.input_ids.shape[1]:], skip_special_tokens=True)
-        response = response.lstrip("<|MOSS|>: ")
-        return response, len(response)
+    def _get_logits_processor(self):
+        return LogitsProcessorList([MossLogitsProcessor(
+            self.temperature, self.repetition_penalty, self.top_k, self.top_p,
+            stopwords=self.moss_stopwords,
+            length_penalty=self.default_paras["length_penalty"],
+            regulation_start=self.default_paras["regulation_start"])])
 
-    def get_answer_stream_iter(self):
-        prompt = self._get_moss_style_inputs()
-        it = self.forward(prompt)
-        for i in it:
-            yield i
+    def _to_cuda(self, tensor: torch.Tensor) -> torch.Tensor:
+        # prompt ids are a few KB and used right away, so pinning a fresh temporary
+        # would only add a page-locked allocation and an extra host copy
+        return tensor if tensor.is_cuda else tensor.cuda()
 
-    def preprocess(self, raw_text: str) -> Tuple[torch.Tensor, torch.Tensor]:
+    def _extend_kv_cache(
+        self,
+        input_ids: torch.Tensor,
+        past_key_values: Optional[Tuple[Tuple[torch.Tensor]]] = None,
+    ) -> Tuple[Tuple[Tuple[torch.Tensor]], torch.Tensor]:
+        # run the tokens past_key_values doesn't cover yet in chunks of prefill_chunk_size,
+        # only through the transformer since the cache is all that's needed from them
+        past_length = 0 if past_key_values is None else past_key_values[0][0].size(-2)
+        for start in range(past_length, input_ids.shape[1], self.prefill_chunk_size):
+            end = min(start + self.prefill_chunk_size, input_ids.shape[1])
+            with torch.no_grad():
+                outputs = MOSS_MODEL.transformer(
+                    input_ids=self._to_cuda(input_ids[:, start:end]),
+                    past_key_values=past_key_values,
+                    use_cache=True)
+            past_key_values = outputs.past_key_values
+        return past_key_values, outputs.last_hidden_state
+
+    def _sample(
+        self,
+        input_ids: torch.Tensor,
+        logits: torch.Tensor,
+        logits_processor: Optional[LogitsProcessorList],
+    ) -> torch.Tensor:
+        if logits_processor is None:
+            logits_processor = self._get_logits_processor()
+        scores = logits_processor(input_ids, logits)
+        return torch.multinomial(torch.softmax(scores, dim=-1), 1)
+
+    def prefill(
+        self,
+        input_ids: torch.Tensor,
+        past_key_values: Optional[Tuple[Tuple[torch.Tensor]]] = None,
+        logits_processor: Optional[LogitsProcessorList] = None,
+    ) -> Tuple[Tuple[Tuple[torch.Tensor]], torch.Tensor]:
         """
-        Preprocesses the raw input text by adding the prefix and tokenizing it.
+        Runs the compute-bound prefill phase in chunks of prefill_chunk_size tokens and samples the first new token.
 
         Args:
-            raw_text (str): The raw input text.
+            input_ids (torch.Tensor): The prompt token IDs, on the CPU or the GPU.
+            past_key_values (Optional[Tuple[Tuple[torch.Tensor]]], optional): A KV cache covering a strict prefix of input_ids. Defaults to None.
+            logits_processor (Optional[LogitsProcessorList], optional): Pass the same one to every decode_step of this sequence. Defaults to a fresh one.
 
         Returns:
-            Tuple[torch.Tensor, torch.Tensor]: A tuple containing the tokenized input IDs and attention mask.
+            Tuple[Tuple[Tuple[torch.Tensor]], torch.Tensor]: The past key values covering all of input_ids, and the new token of shape (batch_size, 1).
         """
+        input_ids = self._to_cuda(input_ids)
+        past_key_values, hidden_states = self._extend_kv_cache(input_ids, past_key_values)
+        with torch.no_grad():
+            # lm_head on the last position only instead of [1, seqlen, vocab_size] logits
+            logits = MOSS_MODEL.lm_head(hidden_states[:, -1, :]).float()
+            new_token = self._sample(input_ids, logits, logits_processor)
+        return past_key_values, new_token
 
-        tokens = MOSS_TOKENIZER.batch_encode_plus(
-            [raw_text], return_tensors="pt")
-        input_ids, attention_mask = tokens['input_ids'], tokens['attention_mask']
-
-        return input_ids, attention_mask
-
-    def forward(
-        self, data: str, paras: Optional[Dict[str, float]] = None
-    ) -> List[str]:
+    def decode_step(
+        self,
+        past_key_values: Tuple[Tuple[torch.Tensor]],
+        input_ids: torch.Tensor,
+        logits_processor: Optional[LogitsProcessorList] = None,
+    ) -> Tuple[Tuple[Tuple[torch.Tensor]], torch.Tensor]:
         """
-        Generates text using the model, given the input data and generation parameters.
+        Runs one memory-bound decode step: feeds the last sampled token and samples the next one.
 
         Args:
-            data (str): The input text for generation.
-            paras (Optional[Dict[str, float]], optional): A dictionary of generation parameters. Defaults to None.
+            past_key_values (Tuple[Tuple[torch.Tensor]]): The KV cache covering input_ids[:, :-1], as returned by prefill or the previous decode_step.
+            input_ids (torch.Tensor): The token IDs so far, ending with the last sampled token, on the CPU or the GPU.
+            logits_processor (Optional[LogitsProcessorList], optional): The one passed to prefill. Defaults to a fresh one.
 
         Returns:
-            List[str]: The list of generated texts.
+            Tuple[Tuple[Tuple[torch.Tensor]], torch.Tensor]: The past key values covering all of input_ids, and the new token of shape (batch_size, 1).
         """
-        input_ids, attention_mask = self.preprocess(data)
-
-        if not paras:
-            paras = self.default_paras
-
-        streaming_iter = self.streaming_topk_search(
-            input_ids,
-            attention_mask,
-            temperature=self.temperature,
-            repetition_penalty=self.repetition_penalty,
-            top_k=self.top_k,
-            top_p=self.top_p,
-            max_iterations=self.max_generation_token,
-            regulation_start=paras["regulation_start"],
-            length_penalty=paras["length_penalty"],
-            max_time=paras["max_time"],
-        )
-
-        for outputs in streaming_iter:
-
-            preds = MOSS_TOKENIZER.batch_decode(outputs)
-
-            res = [pred.lstrip(data) for pred in preds]
-
-            yield res[0]
-
-    def streaming_topk_search(
-        self,
-        input_ids: torch.Tensor,
-        attention_mask: torch.Tensor,
-        temperature: float = 0.7,
-        repetition_penalty: float = 1.1,
-        top_k: int = 0,
-        top_p: float = 0.92,
-        max_iterations: int = 1024,
-        regulation_start: int = 512,
-        length_penalty: float = 1,
-        max_time: int = 60,
-    ) -> torch.Tensor:
+        input_ids = self._to_cuda(input_ids)
+        with torch.no_grad():
+            outputs = MOSS_MODEL(
+                input_ids=input_ids[:, -1:],
+                past_key_values=past_key_values,
+                use_cache=True)
+            new_token = self._sample(input_ids, outputs.logits[:, -1, :], logits_processor)
+        return outputs.past_key_values, new_token
+
+    def _get_past_key_values(self, input_ids: torch.Tensor) -> Tuple[Tuple[torch.Tensor]]:
         """
-        Performs a streaming top-k search using the given parameters.
+        Returns the KV cache for every prompt token except the last one, which prefill feeds itself.
+        The cache is kept across turns, so only tokens that are not cached yet are prefilled.
 
         Args:
-            input_ids (torch.Tensor): The input IDs tensor.
-            attention_mask (torch.Tensor): The attention mask tensor.
-            temperature (float, optional): The temperature for logits. Defaults to 0.7.
-            repetition_penalty (float, optional): The repetition penalty factor. Defaults to 1.1.
-            top_k (int, optional): The top-k value for filtering. Defaults to 0.
-            top_p (float, optional): The top-p value for filtering. Defaults to 0.92.
-            max_iterations (int, optional): The maximum number of iterations. Defaults to 1024.
-            regulation_start (int, optional): The number of iterations after which regulation starts. Defaults to 512.
-            length_penalty (float, optional): The length penalty factor. Defaults to 1.
-            max_time (int, optional): The maximum allowed time in seconds. Defaults to 60.
+            input_ids (torch.Tensor): The tokenized prompt.
 
         Returns:
-            torch.Tensor: The generated output IDs tensor.
+            Tuple[Tuple[torch.Tensor]]: The past key values covering input_ids[:, :-1].
         """
-        assert input_ids.dtype == torch.int64 and attention_mask.dtype == torch.int64
-
-        self.bsz, self.seqlen = input_ids.shape
-
-        input_ids, attention_mask = input_ids.to(
-            'cuda'), attention_mask.to('cuda')
-        last_token_indices = attention_mask.sum(1) - 1
-
-        moss_stopwords = self.moss_stopwords.to(input_ids.device)
-        queue_for_moss_stopwords = torch.empty(size=(self.bsz, len(
-            self.moss_stopwords)), device=input_ids.device, dtype=input_ids.dtype)
-        all_shall_stop = torch.tensor(
-            [False] * self.bsz, device=input_ids.device)
-        moss_stop = torch.tensor([False] * self.bsz, device=input_ids.device)
-
-        generations, start_time = torch.ones(
-            self.bsz, 1, dtype=torch.int64), time.time()
-
-        past_key_values = None
-        for i in range(int(max_iterations)):
-            logits, past_key_values = self.infer_(
-                input_ids if i == 0 else new_generated_id, attention_mask, past_key_values)
-
-            if i == 0:
-                logits = logits.gather(1, last_token_indices.view(
-                    self.bsz, 1, 1).repeat(1, 1, self.vocab_size)).squeeze(1)
-            else:
-                logits = logits[:, -1, :]
-
-            if repetition_penalty > 1:
-                score = logits.gather(1, input_ids)
-                # if score < 0 then repetition penalty has to be multiplied to reduce the previous token probability
-                # just gather the histroy token from input_ids, preprocess then scatter back
-                # here we apply extra work to exclude special token
-
-                score = torch.where(
-                    score < 0, score * repetition_penalty, score / repetition_penalty)
-
-                logits.scatter_(1, input_ids, score)
-
-            logits = logits / temperature
-
-            filtered_logits = self.top_k_top_p_filtering(logits, top_k, top_p)
-            probabilities = torch.softmax(filtered_logits, dim=-1)
-
-            cur_len = i
-            if cur_len > int(regulation_start):
-                for i in self.moss_stopwords:
-                    probabilities[:, i] = probabilities[:, i] * \
-                        pow(length_penalty, cur_len - regulation_start)
-
-            new_generated_id = torch.multinomial(probabilities, 1)
-
-            # update extra_ignored_tokens
-            new_generated_id_cpu = new_generated_id.cpu()
-
-            input_ids, attention_mask = torch.cat([input_ids, new_generated_id], dim=1), torch.cat(
-                [attention_mask, torch.ones((self.bsz, 1), device=attention_mask.device, dtype=attention_mask.dtype)], dim=1)
-
-            generations = torch.cat(
-                [generations, new_generated_id.cpu()], dim=1)
-
-            # stop words components
-            queue_for_moss_stopwords = torch.cat(
-                [queue_for_moss_stopwords[:, 1:], new_generated_id], dim=1)
-
-            moss_stop |= (queue_for_moss_stopwords == moss_stopwords).all(1)
+        with _KV_CACHE_LOCK:
+            # held throughout so another session's eviction can't swap the cache out midway
+            _touch_kv_cache(self)
+            return self._update_kv_cache(input_ids)
+
+    def _update_kv_cache(self, input_ids: torch.Tensor) -> Tuple[Tuple[torch.Tensor]]:
+        prefix_len = input_ids.shape[1] - 1
+        cached_len = 0 if self._kv_cache_ids is None else self._kv_cache_ids.shape[1]
+        common_len = min(cached_len, prefix_len)
+        mismatch = (input_ids[:, :common_len] != self._kv_cache_ids[:, :common_len]).nonzero() \
+            if common_len > 0 else None
+        if mismatch is not None and mismatch.numel() > 0:
+            common_len = int(mismatch[0, 1])
+        if common_len == 0:
+            # drop the ids too so a failed prefill can't leave them paired with no cache
+            self._kv_cache, self._kv_cache_ids, cached_len = None, None, 0
+        elif common_len < cached_len:
+            # history was edited or trimmed: keep the longest common prefix (at least the
+            # system prompt) instead of prefilling everything again; cloned so the slices
+            # don't keep the untrimmed tensors alive
+            self._kv_cache = tuple(
+                tuple(state[..., :common_len, :].clone() for state in layer_past)
+                for layer_past in self._kv_cache
+            )
+            self._kv_cache_ids, cached_len = self._kv_cache_ids[:, :common_len], common_len
 
-            all_shall_stop |= moss_stop
+        if cached_len < prefix_len:
+            self._kv_cache, _ = self._extend_kv_cache(
+                input_ids[:, :prefix_len], self._kv_cache)
+            self._kv_cache_ids = input_ids[:, :prefix_len]
 
-            if all_shall_stop.all().item():
-                break
-            elif time.time() - start_time > max_time:
-                break
+        return self._kv_cache
 
-            yield input_ids
+    def _generate(self, input_ids: torch.Tensor, streamer: Optional[TextIteratorStreamer] = None) -> torch.Tensor:
+        """
+        Samples a reply with one prefill followed by decode_step calls, until <eom>, the token limit or max_time.
 
-    def top_k_top_p_filtering(self, logits, top_k, top_p, filter_value=-float("Inf"), min_tokens_to_keep=1, ):
-        if top_k > 0:
-            # Remove all tokens with a probability less than the last token of the top-k
-            indices_to_remove = logits < torch.topk(logits, top_k)[
-                0][..., -1, None]
-            logits[indices_to_remove] = filter_value
+        Args:
+            input_ids (torch.Tensor): The tokenized prompt.
+            streamer (Optional[TextIteratorStreamer], optional): Receives every new token as it is sampled. Defaults to None.
 
-        if top_p < 1.0:
-            sorted_logits, sorted_indices = torch.sort(logits, descending=True)
-            cumulative_probs = torch.cumsum(
-                torch.softmax(sorted_logits, dim=-1), dim=-1)
+        Returns:
+            torch.Tensor: The generated token IDs, without the prompt and the stop word.
+        """
+        prompt_len = input_ids.shape[1]
+        max_new_tokens = max(min(self.max_generation_token, self.token_upper_limit - prompt_len), 1)
+        logits_processor = self._get_logits_processor()
+        deadline = time.monotonic() + self.default_paras["max_time"]
+
+        # all ids live in one preallocated GPU buffer, each step gets a view of it
+        # instead of re-concatenating the growing sequence
+        ids = torch.empty((1, prompt_len + max_new_tokens), dtype=torch.long, device="cuda")
+        ids[:, :prompt_len].copy_(input_ids)
+        cur_len = prompt_len
+        try:
+            # the cached prefix covers input_ids[:, :-1], so prefill only feeds the last prompt token
+            past_key_values, new_token = self.prefill(
+                ids[:, :cur_len], self._get_past_key_values(input_ids), logits_processor)
+            while True:
+                # one device-to-host copy per token, shared by the stop check and the streamer
+                new_token_cpu = new_token.cpu()
+                if int(new_token_cpu) in self.moss_stopword_ids:
+                    break
+                ids[:, cur_len] = new_token[:, 0]
+                cur_len += 1
+                if streamer is not None:
+                    streamer.put(new_token_cpu[0])
+                if cur_len - prompt_len >= max_new_tokens or time.monotonic() > deadline:
+                    break
+                past_key_values, new_token = self.decode_step(
+                    past_key_values, ids[:, :cur_len], logits_processor)
+        finally:
+            if streamer is not None:
+                streamer.end()
+        return ids[0, prompt_len:cur_len]
 
-            # Remove tokens with cumulative probability above the threshold (token with 0 are kept)
-            sorted_indices_to_remove = cumulative_probs > top_p
-            if min_tokens_to_keep > 1:
-                # Keep at least min_tokens_to_keep (set to min_tokens_to_keep-1 because we add the first one below)
-                sorted_indices_to_remove[..., :min_tokens_to_keep] = 0
-            # Shift the indices to the right to keep also the first token above the threshold
-            sorted_indices_to_remove[...,
-                                     1:] = sorted_indices_to_remove[..., :-1].clone()
-            sorted_indices_to_remove[..., 0] = 0
-            # scatter sorted tensors to original indexing
-            indices_to_remove = sorted_indices_to_remove.scatter(
-                1, sorted_indices, sorted_indices_to_remove)
-            logits[indices_to_remove] = filter_value
+    def get_answer_at_once(self):
+        prompt = self._get_moss_style_inputs()
+        input_ids, _ = self.preprocess(prompt)
+        response = MOSS_TOKENIZER.decode(
+            self._generate(input_ids), skip_special_tokens=True)
+        response = self._strip_moss_prefix(response)
+        return response, len(response)
 
-        return logits
+    def get_answer_stream_iter(self):
+        prompt = self._get_moss_style_inputs()
+        input_ids, _ = self.preprocess(prompt)
+        # the prompt is never put into the streamer, so there is nothing to skip
+        streamer = TextIteratorStreamer(
+            MOSS_TOKENIZER, timeout=60., skip_prompt=False, skip_special_tokens=True)
+        t = Thread(target=self._generate, args=(input_ids, streamer))
+        t.start()
+
+        partial_text = ""
+        for new_text in streamer:
+            partial_text += new_text
+            yield self._strip_moss_prefix(partial_text)
+
+    def reset(self):
+        # free this session's KV cache together with the history
+        with _KV_CACHE_LOCK:
+            _KV_CACHE_LRU.pop(id(self), None)
+            self._kv_cache, self._kv_cache_ids = None, None
+        self._cached_prompt_text, self._cached_prompt_ids = "", None
+        return super().reset()
+
+    def _strip_moss_prefix(self, text):
+        # remove the role prefix as a whole, str.lstrip would strip any of its characters
+        prefix = "<|MOSS|>: "
+        if text.startswith(prefix):
+            return text[len(prefix):]
+        if prefix.startswith(text):
+            return ""
+        return text
 
-    def infer_(
-        self,
-        input_ids: torch.Tensor,
-        attention_mask: torch.Tensor,
-        past_key_values: Optional[Tuple[torch.Tensor]],
-    ) -> Tuple[torch.Tensor, Tuple[torch.Tensor]]:
+    def preprocess(self, raw_text: str) -> Tuple[torch.Tensor, torch.Tensor]:
         """
-        Inference method that computes logits and past key values.
+        Preprocesses the raw input text by adding the prefix and tokenizing it.
 
         Args:
-            input_ids (torch.Tensor): The input IDs tensor.
-            attention_mask (torch.Tensor): The attention mask tensor.
-            past_key_values (Optional[Tuple[torch.Tensor]]): The past key values tuple.
+            raw_text (str): The raw input text.
 
         Returns:
-            Tuple[torch.Tensor, Tuple[torch.Tensor]]: A tuple containing the logits and past key values.
+            Tuple[torch.Tensor, torch.Tensor]: A tuple containing the tokenized input IDs and attention mask.
         """
-        inputs = {
-            "input_ids": input_ids,
-            "attention_mask": attention_mask,
-            "past_key_values": past_key_values,
-        }
-        with torch.no_grad():
-            outputs: BaseModelOutputWithPast = MOSS_MODEL(**inputs)
 
-        return outputs.logits, outputs.past_key_values
-
-    def __call__(self, input):
-        return self.forward(input)
+        if self._cached_prompt_ids is not None and self._cached_prompt_text and raw_text.startswith(self._cached_prompt_text):
+            # the chat history is append-only, so only the new suffix needs to be tokenized;
+            # the cached text always ends on a message boundary so the BPE split is unchanged
+            suffix = raw_text[len(self._cached_prompt_text):]
+            if suffix:
+                suffix_ids = torch.tensor(
+                    [MOSS_TOKENIZER(suffix, add_special_tokens=False)['input_ids']], dtype=torch.long)
+                input_ids = torch.cat([self._cached_prompt_ids, suffix_ids], dim=1)
+            else:
+                # e.g. retry re-sends the same prompt; an empty encoding would be a float tensor
+                input_ids = self._cached_prompt_ids
+        else:
+            tokens = MOSS_TOKENIZER.batch_encode_plus(
+                [raw_text], return_tensors="pt")
+            input_ids = tokens['input_ids']
+        attention_mask = torch.ones_like(input_ids)
+
+        self._cached_prompt_text, self._cached_prompt_ids = raw_text, input_ids
+        return input_ids, attention_mask
 
 
 if __name__ == "__main__":
@@ -22,6 +22,8 @@ from .configuration_moss import MossConfig
 
 logger = logging.get_logger(__name__)
 
+_SDPA_AVAILABLE = hasattr(nn.functional, "scaled_dot_product_attention")
+
 _CHECKPOINT_FOR_DOC = "fnlp/moss-moon-003-base"
 _CONFIG_FOR_DOC = "MossConfig"
 
@@ -145,6 +147,38 @@ class MossAttention(nn.Module):
 
         return attn_output, attn_weights
 
+    def _sdpa_attn(
+        self,
+        query,
+        key,
+        value,
+        attention_mask=None,
+    ):
+        # fused kernel path through torch.nn.functional.scaled_dot_product_attention,
+        # the attention weights are never materialized so None is returned for them.
+        # Only used for bf16/fp32, whose range makes computing QK^T in value.dtype safe
+        query_length, key_length = query.size(-2), key.size(-2)
+        dropout_p = self.attn_dropout.p if self.training else 0.0
+        query = query.to(value.dtype)
+        key = key.to(value.dtype)
+
+        if attention_mask is None and query_length == key_length:
+            attn_output = nn.functional.scaled_dot_product_attention(
+                query, key, value, dropout_p=dropout_p, is_causal=True
+            )
+        else:
+            causal_mask = self.causal_mask[:, :, key_length - query_length : key_length, :key_length]
+            mask_value = torch.finfo(value.dtype).min
+            if attention_mask is None:
+                attention_mask = torch.zeros((), dtype=value.dtype, device=value.device)
+            # use where instead of adding the two masks so masked positions don't overflow to -inf
+            attn_mask = torch.where(causal_mask, attention_mask.to(value.dtype), mask_value)
+            attn_output = nn.functional.scaled_dot_product_attention(
+                query, key, value, attn_mask=attn_mask, dropout_p=dropout_p
+            )
+
+        return attn_output, None
+
     def forward(
         self,
         hidden_states: Optional[torch.FloatTensor],
@@ -210,7 +244,11 @@ class MossAttention(nn.Module):
             present = None
 
         # compute self-attention: V x Softmax(QK^T)
-        attn_output, attn_weights = self._attn(query, key, value, attention_mask, head_mask)
+        # fp16 keeps the eager path, which computes QK^T in fp32 to avoid overflow
+        if _SDPA_AVAILABLE and head_mask is None and not output_attentions and value.dtype != torch.float16:
+            attn_output, attn_weights = self._sdpa_attn(query, key, value, attention_mask)
+        else:
+            attn_output, attn_weights = self._attn(query, key, value, attention_mask, head_mask)
 
         attn_output = self._merge_heads(attn_output, self.num_attention_heads, self.head_dim)
         attn_output = self.out_proj(attn_output)